@@ -3,10 +3,20 @@ import torch
 from TTS.api import TTS
 from pydub import AudioSegment
 import os
-import tempfile
 import base64
 import json
-import time
+import math
+
+import audio_stream
+from scratch import ScratchSpace
+
+# Целевая громкость при "Громкости голоса" 1.0 (LUFS) и потолок истинного пика
+TARGET_LUFS = -16.0
+TRUE_PEAK_DB = -1.0
+# Ползунок громкости сдвигает цель не больше чем на ±6 дБ: речь громче -10 LUFS
+# не помещается под потолок истинного пика без сильного лимитирования
+VOLUME_MIN, VOLUME_MAX = 0.5, 2.0
+LOUDNESS_TOLERANCE_LU = 1.0
 
 # Убедись, что путь к ffmpeg.exe указан верно
 AudioSegment.converter = "C:/ffmpeg/bin/ffmpeg.exe" # Или просто "ffmpeg", если он в PATH
@@ -27,24 +37,23 @@ def get_binary_file_downloader_html(file_path, file_label='File'):
     b64 = base64.b64encode(data).decode()
     return f'<a href=\"data:application/octet-stream;base64,{b64}\" download=\"{os.path.basename(file_path)}\">Скачать {file_label}</a>'
 
-def convert_audio_for_download(input_path, output_format):
+def get_scratch():
+    # Временные файлы сессии: удаляются при вытеснении или вместе с сессией
+    if "scratch" not in st.session_state:
+        st.session_state.scratch = ScratchSpace()
+    return st.session_state.scratch
+
+def convert_audio_for_download(input_path, output_path, output_format):
     audio = AudioSegment.from_file(input_path)
-    with tempfile.NamedTemporaryFile(suffix=f".{output_format}", delete=False) as temp_file:
-        output_path = temp_file.name
-        audio.export(output_path, format=output_format)
-        return output_path
+    audio.export(output_path, format=output_format)
 
 def add_background_sound(voice_path, background_path, output_path, background_volume=0.3):
-    voice = AudioSegment.from_wav(voice_path)
-    background = AudioSegment.from_wav(background_path)
-    
-    if len(background) < len(voice):
-        background = background * (len(voice) // len(background) + 1)
-    background = background[:len(voice)]
-    
-    background = background - (20 * (1 - background_volume)) 
-    combined = voice.overlay(background)
-    combined.export(output_path, format="wav")
+    # Фон декодируется в memmap и накладывается блоками, без копии зацикленного трека
+    audio_stream.mix_background(
+        voice_path, background_path, output_path,
+        gain_db=-(20 * (1 - background_volume)),
+        ffmpeg=AudioSegment.converter
+    )
 
 def load_voices():
     voices = {
@@ -105,6 +114,7 @@ def main():
 
     tts = load_tts()
     voices = load_voices()
+    scratch = get_scratch()
 
     # --- Секция добавления нового голоса ---
     st.subheader("Добавить новый голос")
@@ -118,15 +128,18 @@ def main():
             voice_gender = st.radio("Выберите пол голоса:", ["Мужские", "Женские"], key="new_voice_gender_upload")
         
         if voice_name and st.button("Добавить голос"):
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_new_voice_file.name)[1]) as temp_file:
-                temp_path = temp_file.name
-                temp_file.write(uploaded_new_voice_file.getvalue())
+            temp_path = audio_stream.spool_upload(uploaded_new_voice_file, suffix=os.path.splitext(uploaded_new_voice_file.name)[1])
             
             try:
                 output_path_new_voice = os.path.join("voices", f"{voice_name}.wav")
                 
-                audio_for_new_voice = AudioSegment.from_file(temp_path, format=os.path.splitext(uploaded_new_voice_file.name)[1][1:])
-                audio_for_new_voice.export(output_path_new_voice, format="wav")
+                audio_for_new_voice = audio_stream.decode(
+                    temp_path,
+                    audio_stream.REFERENCE_SAMPLE_RATE,
+                    audio_stream.REFERENCE_CHANNELS,
+                    ffmpeg=AudioSegment.converter
+                )
+                audio_stream.write_wav(audio_for_new_voice, audio_stream.REFERENCE_SAMPLE_RATE, output_path_new_voice)
                 
                 voices[voice_gender][voice_name] = voice_name
                 save_voices(voices)
@@ -151,10 +164,10 @@ def main():
     if st.button("Предпрослушка голоса"):
         preview_text = f"Привет! Меня зовут {voice_name}, я могу озвучить твой текст."
         with st.spinner("Генерируем предпрослушку..."):
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as preview_file:
-                preview_path = preview_file.name
-                speaker_wav_file_for_preview = f"voices/{voices[gender][voice_name]}.wav" 
-                
+            preview_path = scratch.new_path(".wav")
+            speaker_wav_file_for_preview = f"voices/{voices[gender][voice_name]}.wav" 
+            
+            try:
                 tts.tts_to_file(
                     text=preview_text,
                     speaker_wav=speaker_wav_file_for_preview,
@@ -163,13 +176,10 @@ def main():
                     speed=1.0,
                     temperature=0.7
                 )
+                # st.audio читает файл сразу, поэтому его можно удалить без ожидания
                 st.audio(preview_path)
-                time.sleep(1)
-                preview_file.close()
-                try:
-                    os.unlink(preview_path)
-                except PermissionError:
-                    pass
+            finally:
+                scratch.discard(preview_path)
     
     st.divider()
 
@@ -194,8 +204,8 @@ def main():
     with col3:
         volume = st.slider(
             "Громкость голоса:",
-            0.0, 2.0, 1.0, 0.1,
-            help="Регулирует общую громкость синтезированной речи. 1.0 - стандартная."
+            VOLUME_MIN, VOLUME_MAX, 1.0, 0.1,
+            help="Регулирует общую громкость синтезированной речи. 1.0 - стандартная (-16 LUFS), 0.5 и 2.0 - на 6 дБ тише и громче."
         )
     
     add_background = st.checkbox("Добавить фоновый звук")
@@ -205,29 +215,21 @@ def main():
         background_file = st.file_uploader("Загрузите фоновый звук", type=['wav', 'mp3', 'ogg', 'm4a'], key="background_upload")
         if background_file is not None:
             uploaded_bg_extension = background_file.name.split('.')[-1].lower()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_bg_extension}") as bg_temp_file:
-                bg_temp_file.write(background_file.read())
-                uploaded_bg_path = bg_temp_file.name
-            
+            # Фон декодируется потоково при сведении, здесь только копируем загрузку на диск
+            # (один раз на файл, при перезапусках скрипта копия переиспользуется)
             try:
-                converted_bg_path_for_processing = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
-                audio_bg = AudioSegment.from_file(uploaded_bg_path, format=uploaded_bg_extension)
-                audio_bg.export(converted_bg_path_for_processing, format="wav")
+                uploaded_bg_path = scratch.upload("background", background_file, audio_stream.save_upload)
                 
-                st.audio(converted_bg_path_for_processing, format="audio/wav")
+                st.audio(background_file, format=f"audio/{uploaded_bg_extension}")
                 
                 background_volume = st.slider(
                     "Громкость фонового звука:",
                     0.0, 1.0, 0.3, 0.1,
                     help="0 - фон отключен, 1 - максимальная громкость"
                 )
-                background_data = (converted_bg_path_for_processing, background_volume)
-            except Exception as e:
+                background_data = (uploaded_bg_path, background_volume)
+            except (ValueError, OSError) as e:
                 st.error(f"Ошибка обработки фонового звука: {str(e)}")
-                background_data = None
-            finally:
-                if os.path.exists(uploaded_bg_path):
-                    os.unlink(uploaded_bg_path)
 
 
     # --- Секция ввода текста и синтеза ---
@@ -255,26 +257,36 @@ def main():
 
     if temp_speaker_audio_file is not None:
         uploaded_file_extension = temp_speaker_audio_file.name.split('.')[-1].lower()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file_extension}") as temp_audio_file_for_processing:
-            temp_audio_file_for_processing.write(temp_speaker_audio_file.read())
-            uploaded_audio_path_for_processing = temp_audio_file_for_processing.name
+        try:
+            uploaded_audio_path_for_processing = scratch.upload("temp_speaker", temp_speaker_audio_file, audio_stream.save_upload)
+        except (ValueError, OSError) as e:
+            st.error(f"Ошибка загрузки образца голоса: {e}")
+            uploaded_audio_path_for_processing = None
 
-        st.audio(uploaded_audio_path_for_processing, format=f"audio/{uploaded_file_extension}")
+        if uploaded_audio_path_for_processing is not None:
+            st.audio(uploaded_audio_path_for_processing, format=f"audio/{uploaded_file_extension}")
 
-        if uploaded_file_extension != "wav":
-            st.info(f"Конвертируем {uploaded_file_extension.upper()} в WAV для обработки...")
-            try:
-                audio_to_convert = AudioSegment.from_file(uploaded_audio_path_for_processing, format=uploaded_file_extension)
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav_file_for_processing:
-                    final_speaker_wav_path = temp_wav_file_for_processing.name
-                    audio_to_convert.export(final_speaker_wav_path, format="wav")
-                st.success("Конвертация в WAV завершена.")
-                os.unlink(uploaded_audio_path_for_processing)
-            except Exception as e:
-                st.error(f"Ошибка конвертации аудио: {e}")
-                final_speaker_wav_path = None
-        else:
-            final_speaker_wav_path = uploaded_audio_path_for_processing
+            if uploaded_file_extension != "wav":
+                st.info(f"Конвертируем {uploaded_file_extension.upper()} в WAV для обработки...")
+                try:
+                    final_speaker_wav_path = scratch.derived(
+                        uploaded_audio_path_for_processing, ".wav",
+                        lambda out: audio_stream.write_wav(
+                            audio_stream.decode(
+                                uploaded_audio_path_for_processing,
+                                audio_stream.REFERENCE_SAMPLE_RATE,
+                                audio_stream.REFERENCE_CHANNELS,
+                                ffmpeg=AudioSegment.converter
+                            ),
+                            audio_stream.REFERENCE_SAMPLE_RATE, out
+                        )
+                    )
+                    st.success("Конвертация в WAV завершена.")
+                except Exception as e:
+                    st.error(f"Ошибка конвертации аудио: {e}")
+                    final_speaker_wav_path = None
+            else:
+                final_speaker_wav_path = uploaded_audio_path_for_processing
     else:
         final_speaker_wav_path = os.path.join("voices", f"{voices[gender][voice_name]}.wav")
 
@@ -288,81 +300,83 @@ def main():
                 .replace("́ ", "́")
                 )
                 
-                with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-                    temp_path = temp_file.name
-                    temp_file.close()
-                    
-                    output_synthesized_path = temp_path
-                    final_output_path = temp_path
-                    files_to_delete = [temp_path]
-
-                    try:
-                        tts.tts_to_file(
-                            text=processed_text,
-                            speaker_wav=final_speaker_wav_path,
-                            language="ru",
-                            file_path=output_synthesized_path,
-                            speed=speed,
-                            temperature=temperature
-                        )
-                        
-                        synthesized_audio = AudioSegment.from_wav(output_synthesized_path)
-                        delta_dB = 20 * (volume - 1.0)
-                        synthesized_audio = synthesized_audio.apply_gain(delta_dB)
-                        synthesized_audio.export(output_synthesized_path, format="wav")
+                output_synthesized_path = scratch.new_path(".wav")
+                final_output_path = output_synthesized_path
+                files_to_delete = [output_synthesized_path]
 
+                try:
+                    tts.tts_to_file(
+                        text=processed_text,
+                        speaker_wav=final_speaker_wav_path,
+                        language="ru",
+                        file_path=output_synthesized_path,
+                        speed=speed,
+                        temperature=temperature
+                    )
+                    
+                    # Выравнивание по громкости (LUFS): ползунок сдвигает цель относительно TARGET_LUFS
+                    target_lufs = TARGET_LUFS + 20 * math.log10(volume)
+                    result_lufs = audio_stream.loudness_normalize_wav(
+                        output_synthesized_path, output_synthesized_path,
+                        target_lufs=target_lufs,
+                        true_peak_db=TRUE_PEAK_DB
+                    )
 
-                        if add_background and background_data is not None:
-                            bg_path, bg_volume = background_data
-                            final_output_path = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
-                            add_background_sound(
-                                output_synthesized_path, 
-                                bg_path, 
-                                final_output_path, 
-                                background_volume=bg_volume
-                            )
-                            files_to_delete.append(final_output_path)
-                            files_to_delete.append(bg_path)
-                        
-                        st.success("Синтез завершен!")
-                        st.audio(final_output_path, format="audio/wav")
-                        
-                        st.subheader("Скачать в форматах:")
-                        col1, col2, col3 = st.columns(3)
-                        
-                        try:
-                            mp3_path = convert_audio_for_download(final_output_path, "mp3")
-                            col1.markdown(get_binary_file_downloader_html(mp3_path, "MP3"), unsafe_allow_html=True)
-                            files_to_delete.append(mp3_path)
-                        except Exception as e:
-                            st.error(f"Ошибка MP3: {str(e)}")
-                        
-                        col2.markdown(get_binary_file_downloader_html(final_output_path, "WAV"), unsafe_allow_html=True)
-                        
-                        try:
-                            ogg_path = convert_audio_for_download(final_output_path, "ogg")
-                            col3.markdown(get_binary_file_downloader_html(ogg_path, "OGG"), unsafe_allow_html=True)
-                            files_to_delete.append(ogg_path)
-                        except Exception as e:
-                            st.error(f"Ошибка OGG: {str(e)}")
-                        
-                        time.sleep(2)
 
+                    if add_background and background_data is not None:
+                        bg_path, bg_volume = background_data
+                        final_output_path = scratch.new_path(".wav")
+                        add_background_sound(
+                            output_synthesized_path, 
+                            bg_path, 
+                            final_output_path, 
+                            background_volume=bg_volume
+                        )
+                        # Громкость и истинный пик выравниваются по итоговой дорожке с фоном
+                        result_lufs = audio_stream.loudness_normalize_wav(
+                            final_output_path, final_output_path,
+                            target_lufs=target_lufs,
+                            true_peak_db=TRUE_PEAK_DB
+                        )
+                        files_to_delete.append(final_output_path)
+                    
+                    st.success("Синтез завершен!")
+                    if result_lufs < target_lufs - LOUDNESS_TOLERANCE_LU:
+                        st.warning(
+                            f"Громкость {result_lufs:.1f} LUFS ниже заданной ({target_lufs:.1f} LUFS): "
+                            f"пики ограничены на уровне {TRUE_PEAK_DB:.0f} dBTP. Уменьшите громкость голоса."
+                        )
+                    st.audio(final_output_path, format="audio/wav")
+                    
+                    st.subheader("Скачать в форматах:")
+                    col1, col2, col3 = st.columns(3)
+                    
+                    try:
+                        mp3_path = scratch.new_path(".mp3")
+                        files_to_delete.append(mp3_path)
+                        convert_audio_for_download(final_output_path, mp3_path, "mp3")
+                        col1.markdown(get_binary_file_downloader_html(mp3_path, "MP3"), unsafe_allow_html=True)
                     except Exception as e:
-                        st.error(f"Произошла ошибка при синтезе: {e}")
-                    finally:
-                        for path in files_to_delete:
-                            if path and os.path.exists(path):
-                                try:
-                                    os.unlink(path)
-                                except Exception as e:
-                                    st.error(f"Ошибка удаления файла {path}: {str(e)}")
-                        
-                        if temp_speaker_audio_file is not None and final_speaker_wav_path and os.path.exists(final_speaker_wav_path):
-                            try:
-                                os.unlink(final_speaker_wav_path)
-                            except Exception as e:
-                                st.error(f"Ошибка удаления временного файла образца голоса {final_speaker_wav_path}: {str(e)}")
+                        st.error(f"Ошибка MP3: {str(e)}")
+                    
+                    col2.markdown(get_binary_file_downloader_html(final_output_path, "WAV"), unsafe_allow_html=True)
+                    
+                    try:
+                        ogg_path = scratch.new_path(".ogg")
+                        files_to_delete.append(ogg_path)
+                        convert_audio_for_download(final_output_path, ogg_path, "ogg")
+                        col3.markdown(get_binary_file_downloader_html(ogg_path, "OGG"), unsafe_allow_html=True)
+                    except Exception as e:
+                        st.error(f"Ошибка OGG: {str(e)}")
+
+                except Exception as e:
+                    st.error(f"Произошла ошибка при синтезе: {e}")
+                finally:
+                    # Плеер и ссылки уже содержат данные, файлы больше не нужны
+                    for path in files_to_delete:
+                        scratch.discard(path)
+                    # Вытеснение только после синтеза; сконвертированный образец еще пригодится
+                    scratch.evict(keep=[final_speaker_wav_path])
         else:
             st.warning("Пожалуйста, загрузите образец голоса или выберите голос из списка.")
 
@@ -1,23 +1,23 @@
 import streamlit as st
 import torch
-import torchaudio
 
-# Use the 'soundfile' backend for torchaudio to avoid optional torchcodec dependency
-try:
-    torchaudio.set_audio_backend("soundfile")
-except Exception:
-    # ignore if backend can't be set; torchaudio will fall back to defaults
-    pass
-
-from TTS.api import TTS
 from pydub import AudioSegment, effects
 from pydub.silence import split_on_silence
 import os
-import tempfile
 import base64
 import json
 import time
 import shutil
+import queue
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import audio_stream
+from scratch import ScratchSpace
+from tts_replica import PRECISION_DTYPES, ModelReplica, load_xtts
+from tts_worker import ProcessReplica
 
 # --- КОНФИГУРАЦИЯ ---
 # AudioSegment.converter = "C:/ffmpeg/bin/ffmpeg.exe" 
@@ -25,6 +25,22 @@ import shutil
 ST_PAGE_TITLE = "🎙️ AI Voice Studio Pro"
 VOICES_DIR = "voices_pro"
 
+# Размещение модели (переменные окружения, чтобы не трогать код на сервере)
+TTS_PRECISION = os.environ.get("TTS_PRECISION", "fp32")  # fp32 | fp16 | bf16 | auto
+TTS_DEVICES = os.environ.get("TTS_DEVICES", "")  # например "cuda:0,cuda:1" или "cpu,cpu"
+TTS_REPLICAS = int(os.environ.get("TTS_REPLICAS", "0"))  # 0 - по числу устройств
+TTS_IDLE_OFFLOAD_SEC = float(os.environ.get("TTS_IDLE_OFFLOAD_SEC", "300"))  # 0 - не выгружать
+
+SCENE_LINE_GAP_SEC = 0.3  # пауза между репликами сцены по умолчанию
+
+# Профили громкости выхода: целевая интегральная громкость и потолок истинного пика
+LOUDNESS_PROFILES = {
+    "IVR / телефония (-16 LUFS)": {"target_lufs": -16.0, "true_peak_db": -1.0},
+    "Эфир EBU R128 (-23 LUFS)": {"target_lufs": -23.0, "true_peak_db": -1.0},
+    "Веб / стриминг (-14 LUFS)": {"target_lufs": -14.0, "true_peak_db": -1.0},
+    "Только пик (без выравнивания громкости)": None,
+}
+
 # --- CSS И СТИЛЬ ---
 def setup_style():
     st.markdown("""
@@ -54,22 +70,124 @@ def setup_style():
     """, unsafe_allow_html=True)
 
 # --- БЭКЕНД: TTS ---
+class ModelPool:
+    """Диспетчер заданий синтеза поверх нескольких реплик модели.
+
+    Интерфейс совпадает с TTS (`tts_to_file`), поэтому UI не знает, сколько реплик
+    работает и на каких устройствах. Задание получает первую свободную реплику.
+    """
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self._free = queue.Queue()
+        for replica in replicas:
+            self._free.put(replica)
+
+    def _dispatch(self, method, *args, **kwargs):
+        replica = self._free.get()
+        try:
+            return getattr(replica, method)(*args, **kwargs)
+        finally:
+            self._free.put(replica)
+
+    def tts_to_file(self, **kwargs):
+        return self._dispatch("tts_to_file", **kwargs)
+
+    def synthesize_lines(self, speaker_wav, texts, **params):
+        return self._dispatch("synthesize_lines", speaker_wav, texts, **params)
+
+    def describe(self):
+        return ", ".join(
+            f"{r.device} ({r.precision}{', выгружена' if r.offloaded else ''})" for r in self.replicas
+        )
+
+
+def _numa_cpusets():
+    """Наборы ядер по NUMA-узлам (Linux). Без NUMA-информации возвращает []."""
+    nodes_dir = "/sys/devices/system/node"
+    cpusets = []
+    if not os.path.isdir(nodes_dir):
+        return cpusets
+    for node in sorted(os.listdir(nodes_dir)):
+        cpulist_path = os.path.join(nodes_dir, node, "cpulist")
+        if not (node.startswith("node") and os.path.exists(cpulist_path)):
+            continue
+        with open(cpulist_path) as f:
+            cpulist = f.read().strip()
+        cpus = set()
+        for part in filter(None, cpulist.split(",")):
+            start, _, end = part.partition("-")
+            cpus.update(range(int(start), int(end or start) + 1))
+        if cpus:
+            cpusets.append(cpus)
+    return cpusets
+
+
+def _resolve_devices():
+    """Список (устройство, набор ядер) для реплик.
+
+    TTS_DEVICES задает устройства явно ("cuda:0,cuda:1" или "cpu,cpu"),
+    иначе берутся все GPU, а без CUDA — по реплике на NUMA-узел.
+    TTS_REPLICAS ограничивает или расширяет число реплик по кругу.
+    На машине с несколькими NUMA-узлами CPU-реплики раскладываются по узлам
+    по кругу, а реплики одного узла делят его ядра, чтобы не конкурировать за них.
+    """
+    cpusets = _numa_cpusets()
+    if TTS_DEVICES:
+        devices = [d.strip() for d in TTS_DEVICES.split(",") if d.strip()]
+    elif torch.cuda.is_available():
+        devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    else:
+        devices = ["cpu"] * max(len(cpusets), 1)
+
+    count = TTS_REPLICAS or len(devices)
+    placement = [(devices[i % len(devices)], None) for i in range(count)]
+    if len(cpusets) < 2:
+        return placement
+    cpu_slots = [i for i, (device, _) in enumerate(placement) if device == "cpu"]
+    for node, cpus in enumerate(cpusets):
+        slots = cpu_slots[node::len(cpusets)]
+        cores = sorted(cpus)
+        for j, slot in enumerate(slots):
+            placement[slot] = ("cpu", set(cores[j::len(slots)]) or cpus)
+    return placement
+
+
+def _resolve_precision(device):
+    """Понижает запрошенную точность до поддерживаемой устройством."""
+    precision = TTS_PRECISION
+    if precision == "auto":
+        if device.startswith("cuda"):
+            return "bf16" if torch.cuda.is_bf16_supported() else "fp16"
+        return "fp32"
+    if precision == "fp16" and not device.startswith("cuda"):
+        # fp16 на CPU медленнее fp32, используем bf16
+        return "bf16"
+    if precision == "bf16" and device.startswith("cuda") and not torch.cuda.is_bf16_supported():
+        return "fp16"
+    return precision if precision in PRECISION_DTYPES else "fp32"
+
+
 @st.cache_resource
 def load_tts_model():
-    """Загрузка модели XTTS v2. Кешируется для скорости."""
-    original_load = torch.load
-    # обход warning'а о weights_only в новых версиях torch
-    torch.load = lambda *args, **kwargs: original_load(*args, **kwargs, weights_only=False)
+    """Загрузка пула реплик XTTS v2. Кешируется для скорости."""
     try:
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        # Используем XTTS v2 - он лучший для RU в open-source на данный момент
-        model = TTS("tts_models/multilingual/multi-dataset/xtts_v2").to(device)
-        return model
+        replicas = []
+        # Реплики поднимаются по очереди: первая при необходимости скачивает модель
+        for device, cpus in _resolve_devices():
+            precision = _resolve_precision(device)
+            if cpus:
+                # Привязка к ядрам работает только на весь процесс, см. tts_worker
+                replicas.append(ProcessReplica(cpus, precision=precision))
+                continue
+            replicas.append(ModelReplica(
+                load_xtts(device), device,
+                precision=precision,
+                idle_offload_sec=TTS_IDLE_OFFLOAD_SEC,
+            ))
+        return ModelPool(replicas)
     except Exception as e:
         st.error(f"Критическая ошибка загрузки модели: {e}")
         return None
-    finally:
-        torch.load = original_load
 
 # --- БЭКЕНД: УПРАВЛЕНИЕ ГОЛОСАМИ ---
 class VoiceManager:
@@ -86,10 +204,10 @@ class VoiceManager:
         speaker_path = os.path.join(self.base_dir, speaker_name)
         if not os.path.exists(speaker_path):
             return []
-        return [f for f in os.listdir(speaker_path) if f.endswith(('.wav', '.mp3'))]
+        return sorted(f for f in os.listdir(speaker_path) if f.endswith(('.wav', '.mp3')))
 
-    def save_voice(self, speaker_name, style_name, audio_bytes, file_ext):
-        """Сохраняет новый сэмпл голоса."""
+    def save_voice(self, speaker_name, style_name, audio_file, file_ext):
+        """Сохраняет новый сэмпл голоса из загруженного файла."""
         speaker_path = os.path.join(self.base_dir, speaker_name)
         os.makedirs(speaker_path, exist_ok=True)
         
@@ -98,16 +216,17 @@ class VoiceManager:
         filename = f"{safe_style_name}.wav" # Всегда сохраняем как wav для совместимости
         file_path = os.path.join(speaker_path, filename)
 
-        # Конвертация любого входа в чистый WAV (mono, 22050Hz или 24000Hz оптимально для XTTS)
-        with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as tmp:
-            tmp.write(audio_bytes)
-            tmp_path = tmp.name
+        # Конвертация любого входа в чистый WAV (mono, 24000Hz оптимально для XTTS)
+        tmp_path = audio_stream.spool_upload(audio_file, suffix=file_ext)
         
         try:
-            audio = AudioSegment.from_file(tmp_path)
+            audio = audio_stream.decode(
+                tmp_path, audio_stream.REFERENCE_SAMPLE_RATE, audio_stream.REFERENCE_CHANNELS,
+                ffmpeg=AudioSegment.converter,
+            )
             # Нормализация громкости референса
-            audio = effects.normalize(audio)
-            audio.export(file_path, format="wav")
+            gain = audio_stream.peak_gain(audio)
+            audio_stream.write_wav(audio, audio_stream.REFERENCE_SAMPLE_RATE, file_path, gain=gain)
             return True, "Голос успешно сохранен"
         except Exception as e:
             return False, str(e)
@@ -126,10 +245,11 @@ class VoiceManager:
 # --- БЭКЕНД: ОБРАБОТКА АУДИО ---
 class AudioProcessor:
     @staticmethod
-    def post_process_audio(input_path, output_path, remove_silence=True, normalize=True):
-        """Улучшает синтезированное аудио."""
-        audio = AudioSegment.from_wav(input_path)
-        
+    def post_process_audio(input_path, output_path, remove_silence=True, normalize=True, loudness=None):
+        """Улучшает синтезированное аудио.
+
+        loudness - профиль из LOUDNESS_PROFILES; без него только пиковая нормализация.
+        """
         # 1. Удаление тишины в начале и конце
         if remove_silence:
             # Грубая обрезка тишины
@@ -144,29 +264,163 @@ class AudioProcessor:
             pass # Pydub не имеет простого .strip(), оставим как есть или добавим логику позже
 
         # 2. Нормализация
-        if normalize:
-            audio = effects.normalize(audio)
-
-        audio.export(output_path, format="wav")
+        if normalize and loudness:
+            # Выравнивание по громкости (EBU R128), чтобы разные голоса звучали одинаково
+            audio_stream.loudness_normalize_wav(input_path, output_path, **loudness)
+        else:
+            audio = AudioSegment.from_wav(input_path)
+            if normalize:
+                audio = effects.normalize(audio)
+            audio.export(output_path, format="wav")
 
     @staticmethod
     def mix_background(voice_path, bg_path, output_path, bg_volume=0.2):
-        """Накладывает музыку с приглушением."""
-        voice = AudioSegment.from_wav(voice_path)
-        bg = AudioSegment.from_file(bg_path)
-        
-        # Зацикливаем фон если он короче голоса
-        if len(bg) < len(voice) + 1000: # +1 секунда хвоста
-            loop_count = (len(voice) // len(bg)) + 2
-            bg = bg * loop_count
-            
-        bg = bg[:len(voice) + 500] # Фон чуть длиннее голоса
-        
+        """Накладывает музыку с приглушением (фон зацикливается, обработка блоками)."""
         # Понижаем громкость фона
-        bg = bg - (30 * (1 - bg_volume)) # Эвристическая формула громкости
-        
-        combined = voice.overlay(bg)
-        combined.export(output_path, format="wav")
+        gain_db = -(30 * (1 - bg_volume)) # Эвристическая формула громкости
+        audio_stream.mix_background(voice_path, bg_path, output_path, gain_db, ffmpeg=AudioSegment.converter)
+
+# --- БЭКЕНД: СЦЕНЫ (ДИАЛОГИ) ---
+SCENE_PAUSE_RE = re.compile(r"^\((?:пауза|pause)\s+(\d+(?:[.,]\d+)?)\s*(?:с|сек|s)?\)$", re.IGNORECASE)
+SCENE_LINE_RE = re.compile(r"^(?P<voice>[^:\[]+?)\s*(?:\[(?P<gain>[+-]?\d+(?:[.,]\d+)?)\s*dB\])?\s*:\s*(?P<text>.+)$", re.IGNORECASE)
+
+
+class ScenePause:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class SceneLine:
+    def __init__(self, speaker, style_file, text, gain_db=0.0):
+        self.speaker = speaker
+        self.style_file = style_file
+        self.text = text
+        self.gain_db = gain_db
+
+
+def _resolve_voice(vm, voice):
+    """'Мария', 'Мария/Строгий' или 'Артур(веселый)' -> (персонаж, файл стиля)."""
+    speaker, _, style = voice.partition("/")
+    speaker, style = speaker.strip(), style.strip()
+    if speaker not in vm.get_speakers():
+        match = re.match(r"^(.+?)\s*\((.+)\)$", speaker)
+        if match and not style:
+            speaker, style = match.group(1).strip(), match.group(2).strip()
+    styles = vm.get_styles(speaker)
+    if not styles:
+        raise ValueError(f"Нет голоса '{speaker}'")
+    if not style:
+        return speaker, styles[0]
+    for style_file in styles:
+        if os.path.splitext(style_file)[0].lower() == style.lower():
+            return speaker, style_file
+    raise ValueError(f"У голоса '{speaker}' нет стиля '{style}'")
+
+
+def parse_scene(script, vm):
+    """Разбирает сценарий диалога.
+
+    Формат, по одной реплике на строку:
+        Артур/Веселый: Здравствуйте!
+        Мария [-3dB]: Добрый день.
+        (пауза 1.5)
+    Стиль и усиление необязательны. Пустые строки и строки с # пропускаются.
+    """
+    events = []
+    for number, raw in enumerate(script.splitlines(), start=1):
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        pause = SCENE_PAUSE_RE.match(line)
+        if pause:
+            events.append(ScenePause(float(pause.group(1).replace(",", "."))))
+            continue
+        match = SCENE_LINE_RE.match(line)
+        if not match:
+            raise ValueError(f"Строка {number}: ожидается 'Персонаж: текст' или '(пауза N)'")
+        try:
+            speaker, style_file = _resolve_voice(vm, match.group("voice"))
+        except ValueError as e:
+            raise ValueError(f"Строка {number}: {e}") from None
+        gain = match.group("gain")
+        events.append(SceneLine(
+            speaker, style_file, match.group("text").strip(),
+            gain_db=float(gain.replace(",", ".")) if gain else 0.0,
+        ))
+    if not any(isinstance(e, SceneLine) for e in events):
+        raise ValueError("В сценарии нет ни одной реплики")
+    return events
+
+
+class SceneRenderer:
+    """Озвучивает сцену несколькими голосами.
+
+    Реплики группируются по голосу: каждая группа синтезируется одним заданием
+    на одной реплике модели (латенты голоса считаются один раз), а группы разных
+    голосов идут параллельно на разных репликах пула.
+    """
+    def __init__(self, tts, base_dir=VOICES_DIR, line_gap_sec=SCENE_LINE_GAP_SEC):
+        self.tts = tts
+        self.base_dir = base_dir
+        self.line_gap_sec = line_gap_sec
+
+    def _synthesize(self, events, params, progress=None):
+        groups = {}
+        for index, event in enumerate(events):
+            if isinstance(event, SceneLine):
+                groups.setdefault((event.speaker, event.style_file), []).append(index)
+
+        clips = {}
+        sample_rate = None
+        with ThreadPoolExecutor(max_workers=len(self.tts.replicas)) as executor:
+            futures = {}
+            for (speaker, style_file), indices in groups.items():
+                ref_path = os.path.join(self.base_dir, speaker, style_file)
+                texts = [events[i].text for i in indices]
+                future = executor.submit(self.tts.synthesize_lines, ref_path, texts, language="ru", **params)
+                futures[future] = (speaker, indices)
+            for future in as_completed(futures):
+                speaker, indices = futures[future]
+                sample_rate, wavs = future.result()
+                clips.update(zip(indices, wavs))
+                if progress:
+                    progress(f"Готов голос: {speaker} ({len(indices)} реплик)")
+        return sample_rate, clips
+
+    def render(self, events, output_path, params, progress=None):
+        """Синтезирует сцену и собирает дорожку в WAV."""
+        sample_rate, clips = self._synthesize(events, params, progress)
+        gap = int(self.line_gap_sec * sample_rate)
+
+        # Раскладка по времени: начало каждой реплики
+        starts, indices = [], []
+        cursor = 0
+        for index, event in enumerate(events):
+            if isinstance(event, ScenePause):
+                cursor += int(event.seconds * sample_rate)
+                continue
+            if indices:
+                cursor += gap
+            starts.append(cursor)
+            indices.append(index)
+            cursor += len(clips[index])
+
+        # Сведение одной векторной операцией: все реплики с их усилением
+        # раскладываются в дорожку по заранее посчитанным позициям
+        lengths = np.array([len(clips[i]) for i in indices])
+        gains = np.array([10 ** (events[i].gain_db / 20) for i in indices], dtype=np.float32)
+        samples = np.concatenate([clips[i] for i in indices]) * np.repeat(gains, lengths)
+        positions = np.repeat(np.array(starts) - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        track = np.zeros(cursor, dtype=np.float32)
+        track[positions] = samples
+
+        # Реплики с усилением [+N dB] могут выйти за 0 dBFS: уменьшаем всю дорожку,
+        # чтобы запись в int16 не срезала пики (громкость выравнивается дальше)
+        peak = np.abs(track).max()
+        if peak > 1.0:
+            track /= peak
+
+        audio_stream.write_wav(track[:, None], sample_rate, output_path)
 
 # --- UI КОМПОНЕНТЫ ---
 def get_download_link(file_path, label):
@@ -176,6 +430,30 @@ def get_download_link(file_path, label):
     filename = os.path.basename(file_path)
     return f'<a href="data:application/octet-stream;base64,{b64}" download="{filename}" style="text-decoration:none; background-color:#4CAF50; color:white; padding:8px 12px; border-radius:4px; font-weight:bold;">📥 Скачать {label}</a>'
 
+def get_scratch():
+    """Папка временных файлов текущей сессии (удаляется вместе с сессией)."""
+    if "scratch" not in st.session_state:
+        st.session_state.scratch = ScratchSpace()
+    return st.session_state.scratch
+
+def displayed_results():
+    """Результаты, которые показываются на вкладках и не должны вытесняться."""
+    return [st.session_state.get("last_result"), st.session_state.get("last_scene_result")]
+
+def render_result(final_path, scratch):
+    """Плеер и ссылки на скачивание. MP3 кодируется один раз и переиспользуется при перезапусках."""
+    st.audio(final_path)
+    
+    c1, c2, c3 = st.columns(3)
+    c1.markdown(get_download_link(final_path, "WAV (Лучшее качество)"), unsafe_allow_html=True)
+    
+    # Конвертация в MP3 для скачивания (легче вес)
+    mp3_path = scratch.derived(
+        final_path, ".mp3",
+        lambda out: AudioSegment.from_wav(final_path).export(out, format="mp3", bitrate="192k")
+    )
+    c2.markdown(get_download_link(mp3_path, "MP3 (Для веба)"), unsafe_allow_html=True)
+
 # --- ГЛАВНАЯ ЛОГИКА ---
 def main():
     st.set_page_config(page_title="AI Voice Studio", layout="wide", page_icon="🎙️")
@@ -186,6 +464,7 @@ def main():
     # Инициализация
     tts = load_tts_model()
     vm = VoiceManager()
+    scratch = get_scratch()
     
     # Сайдбар с настройками
     with st.sidebar:
@@ -196,12 +475,26 @@ def main():
                                 help="Низкая (0.1) - робот, стабильно. Высокая (0.8) - живо, но могут быть артефакты.")
         repetition_penalty = st.slider("Штраф за повторы", 1.0, 10.0, 2.0, 0.5, 
                                        help="Увеличьте, если голос начинает 'заедать' или повторять слоги.")
+        loudness_profile = st.selectbox(
+            "Громкость выхода", list(LOUDNESS_PROFILES),
+            help="Выравнивание по интегральной громкости (LUFS) с ограничением истинного пика. "
+                 "Все голоса на линии звучат одинаково громко."
+        )
+        loudness = LOUDNESS_PROFILES[loudness_profile]
         
+        if tts:
+            st.caption(f"Модель: {tts.describe()}")
+        m = scratch.metrics
+        st.caption(
+            f"Временные файлы: {scratch.usage() / 1024 / 1024:.1f} МБ, "
+            f"кеш {m['hits']}/{m['hits'] + m['misses']}, вытеснено {m['evicted_files']}"
+        )
+
         st.divider()
         st.info("**Совет для IVR:** Для меню используйте скорость 1.1 и низкую вариативность (0.4). Для рекламы — скорость 1.0 и высокую вариативность (0.7+).")
 
     # Вкладки основного интерфейса
-    tab_generate, tab_voices, tab_help = st.tabs(["Озвучка", "Лаборатория голосов", "Как пользоваться"])
+    tab_generate, tab_scene, tab_voices, tab_help = st.tabs(["Озвучка", "Диалог", "Лаборатория голосов", "Как пользоваться"])
 
     # --- Вкл 1: ОЗВУЧКА ---
     with tab_generate:
@@ -259,8 +552,7 @@ def main():
                     # Пути
                     ref_audio_path = os.path.join(VOICES_DIR, selected_speaker, selected_style_file)
                     
-                    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav:
-                        output_path = temp_wav.name
+                    output_path = scratch.new_path(".wav")
                     
                     try:
                         # 1. Генерация
@@ -281,39 +573,118 @@ def main():
                         
                         # 2. Пост-обработка
                         status.write("Нормализация и обработка...")
-                        AudioProcessor.post_process_audio(output_path, output_path)
+                        AudioProcessor.post_process_audio(output_path, output_path, loudness=loudness)
                         
                         # 3. Наложение фона
                         final_path = output_path
                         if uploaded_bg:
                             status.write("Сведение с фоновой музыкой...")
-                            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as bg_tmp:
-                                bg_tmp.write(uploaded_bg.getvalue())
-                                bg_tmp_path = bg_tmp.name
+                            # Копия загрузки переиспользуется при следующих генерациях с тем же фоном
+                            bg_tmp_path = scratch.upload("bg_main", uploaded_bg, audio_stream.save_upload)
                             
-                            mixed_path = output_path.replace(".wav", "_mixed.wav")
+                            mixed_path = scratch.new_path("_mixed.wav")
                             AudioProcessor.mix_background(output_path, bg_tmp_path, mixed_path, bg_volume=bg_vol)
+                            if loudness:
+                                # Громкость и истинный пик выравниваются по итоговой дорожке с фоном
+                                audio_stream.loudness_normalize_wav(mixed_path, mixed_path, **loudness)
+                            # Без фона промежуточный файл больше не нужен
+                            scratch.discard(output_path)
                             final_path = mixed_path
-                            os.unlink(bg_tmp_path)
 
                         status.update(label="Готово!", state="complete", expanded=False)
                         st.success(f"Сгенерировано за {time.time() - start_time:.2f} сек.")
                         
-                        # Вывод результата
-                        st.audio(final_path)
+                        # Предыдущий результат больше не показывается
+                        previous = st.session_state.get("last_result")
+                        if previous:
+                            scratch.discard(previous)
+                        st.session_state.last_result = final_path
+
+                    except Exception as e:
+                        scratch.discard(output_path)
+                        st.error(f"Ошибка: {e}")
+                    finally:
+                        # Вытеснение только после того, как результат готов
+                        scratch.evict(keep=displayed_results())
+
+        # Вывод результата (сохраняется между перезапусками скрипта)
+        last_result = st.session_state.get("last_result")
+        if last_result and scratch.touch(last_result):
+            render_result(last_result, scratch)
+
+    # --- Вкл 2: ДИАЛОГ ---
+    with tab_scene:
+        col_script, col_scene_opts = st.columns([2, 1])
+        
+        with col_script:
+            scene_script = st.text_area(
+                "Сценарий:",
+                height=300,
+                placeholder="Артур(веселый): Здравствуйте! Вы позвонили в компанию Вектор.\n(пауза 0.5)\nМария [-2dB]: Чтобы связаться с оператором, нажмите один.",
+                help="Одна реплика на строку: 'Персонаж: текст' или 'Персонаж/Стиль: текст'. "
+                     "Громкость реплики: 'Мария [-3dB]: ...'. Пауза: '(пауза 1.5)'."
+            )
+        
+        with col_scene_opts:
+            st.caption("Доступные голоса: " + (", ".join(vm.get_speakers()) or "нет"))
+            line_gap = st.slider("Пауза между репликами, сек", 0.0, 2.0, SCENE_LINE_GAP_SEC, 0.1)
+            scene_bg = st.file_uploader("Музыка на фон", type=['mp3', 'wav'], key="bg_scene")
+            scene_bg_vol = 0.2
+            if scene_bg:
+                scene_bg_vol = st.slider("Громкость фона", 0.0, 1.0, 0.2, key="bg_scene_vol")
+            do_render_scene = st.button("ОЗВУЧИТЬ СЦЕНУ", type="primary", disabled=not scene_script)
+
+        if do_render_scene:
+            if not tts:
+                st.error("Модель не загружена.")
+            else:
+                with st.status("Озвучка сцены...", expanded=True) as status:
+                    start_time = time.time()
+                    output_path = scratch.new_path(".wav")
+                    try:
+                        events = parse_scene(scene_script, vm)
+                        
+                        status.write("Синтез реплик по голосам...")
+                        renderer = SceneRenderer(tts, line_gap_sec=line_gap)
+                        renderer.render(
+                            events, output_path,
+                            params=dict(speed=speed, temperature=temperature, repetition_penalty=repetition_penalty),
+                            progress=status.write,
+                        )
                         
-                        c1, c2, c3 = st.columns(3)
-                        c1.markdown(get_download_link(final_path, "WAV (Лучшее качество)"), unsafe_allow_html=True)
+                        status.write("Нормализация и обработка...")
+                        AudioProcessor.post_process_audio(output_path, output_path, loudness=loudness)
+                        
+                        final_path = output_path
+                        if scene_bg:
+                            status.write("Сведение с фоновой музыкой...")
+                            bg_tmp_path = scratch.upload("bg_scene", scene_bg, audio_stream.save_upload)
+                            final_path = scratch.new_path("_mixed.wav")
+                            AudioProcessor.mix_background(output_path, bg_tmp_path, final_path, bg_volume=scene_bg_vol)
+                            if loudness:
+                                audio_stream.loudness_normalize_wav(final_path, final_path, **loudness)
+                            scratch.discard(output_path)
+
+                        status.update(label="Готово!", state="complete", expanded=False)
+                        st.success(f"Сцена озвучена за {time.time() - start_time:.2f} сек.")
                         
-                        # Конвертация в MP3 для скачивания (легче вес)
-                        mp3_path = final_path.replace(".wav", ".mp3")
-                        AudioSegment.from_wav(final_path).export(mp3_path, format="mp3", bitrate="192k")
-                        c2.markdown(get_download_link(mp3_path, "MP3 (Для веба)"), unsafe_allow_html=True)
+                        previous = st.session_state.get("last_scene_result")
+                        if previous:
+                            scratch.discard(previous)
+                        st.session_state.last_scene_result = final_path
 
                     except Exception as e:
+                        scratch.discard(output_path)
+                        status.update(label="Ошибка", state="error")
                         st.error(f"Ошибка: {e}")
+                    finally:
+                        scratch.evict(keep=displayed_results())
 
-    # --- Вкл 2: ЛАБОРАТОРИЯ ГОЛОСОВ ---
+        last_scene_result = st.session_state.get("last_scene_result")
+        if last_scene_result and scratch.touch(last_scene_result):
+            render_result(last_scene_result, scratch)
+
+    # --- Вкл 3: ЛАБОРАТОРИЯ ГОЛОСОВ ---
     with tab_voices:
         st.header("Управление банком голосов")
         st.markdown("""
@@ -332,7 +703,7 @@ def main():
             if st.button("Сохранить голос"):
                 if new_speaker_name and new_style_name and uploaded_ref:
                     file_ext = os.path.splitext(uploaded_ref.name)[1]
-                    success, msg = vm.save_voice(new_speaker_name, new_style_name, uploaded_ref.read(), file_ext)
+                    success, msg = vm.save_voice(new_speaker_name, new_style_name, uploaded_ref, file_ext)
                     if success:
                         st.success(msg)
                         time.sleep(1)
@@ -360,7 +731,7 @@ def main():
                     if not styles:
                         st.write("Нет стилей.")
 
-    # --- Вкл 3: ПОМОЩЬ ---
+    # --- Вкл 4: ПОМОЩЬ ---
     with tab_help:
         st.markdown("""
         ### Как добиться высокого качества для IVR?
@@ -381,6 +752,12 @@ def main():
         
         **4. Подготовка сэмпла**
         Загружайте чистый звук без шумов. Длительность от 6 до 10 секунд идеальна.
+        
+        **5. Диалоги (вкладка "Диалог")**
+        Пишите по одной реплике на строку: `Артур/Веселый: текст`. Без стиля берется первый стиль персонажа.
+        * `Мария [-3dB]: текст` — сделать реплику тише (или громче с `+`).
+        * `(пауза 1.5)` — пауза в секундах.
+        * Все реплики одного персонажа синтезируются вместе, разные персонажи — параллельно.
         """)
 
 if __name__ == "__main__":
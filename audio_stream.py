@@ -0,0 +1,270 @@
+"""Потоковая обработка длинных аудиофайлов.
+
+Загрузки не читаются целиком в AudioSegment: файл копируется на диск кусками,
+FFmpeg декодирует его в сырой float32, а дальше он открывается как np.memmap.
+Зацикливание и наложение фона, нормализация и запись WAV идут блоками, поэтому
+пиковое потребление памяти зависит от BLOCK_FRAMES, а не от длины трека.
+"""
+import shutil
+import subprocess
+import tempfile
+import wave
+
+import numpy as np
+
+BLOCK_FRAMES = 65536  # ~2.7 сек при 24 кГц
+COPY_CHUNK = 1024 * 1024
+
+# Рекомендуемый формат референсов для XTTS
+REFERENCE_SAMPLE_RATE = 24000
+REFERENCE_CHANNELS = 1
+
+PCM_DTYPES = {2: "<i2", 4: "<i4"}
+
+
+def save_upload(uploaded_file, output_path):
+    """Копирует загруженный файл на диск кусками, без getvalue()."""
+    uploaded_file.seek(0)
+    with open(output_path, "wb") as out:
+        shutil.copyfileobj(uploaded_file, out, COPY_CHUNK)
+
+
+def spool_upload(uploaded_file, suffix=""):
+    """Копирует загруженный файл во временный файл и возвращает путь к нему."""
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+        output_path = tmp.name
+    save_upload(uploaded_file, output_path)
+    return output_path
+
+
+def decode(src_path, sample_rate, channels, ffmpeg="ffmpeg", duration=None):
+    """Декодирует файл в float32 буфер формы (frames, channels), отображенный в память.
+
+    Буфер лежит в анонимном временном файле и удаляется вместе с массивом.
+    duration (сек) ограничивает декодирование началом файла.
+    """
+    cmd = [ffmpeg, "-nostdin", "-v", "error"]
+    if duration is not None:
+        # Входная опция: FFmpeg перестает читать файл, а не декодирует его целиком
+        cmd += ["-t", f"{duration:.6f}"]
+    cmd += [
+        "-i", src_path,
+        "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ac", str(channels), "-ar", str(sample_rate), "-",
+    ]
+    # stderr пишется в файл: при чтении из двух каналов FFmpeg может заблокироваться,
+    # заполнив буфер stderr, пока мы читаем stdout
+    with tempfile.TemporaryFile() as raw, tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        with proc.stdout:
+            shutil.copyfileobj(proc.stdout, raw, COPY_CHUNK)
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"FFmpeg не смог декодировать файл: {stderr.read().decode(errors='replace').strip()}")
+        raw.flush()
+
+        frames = raw.tell() // (4 * channels)
+        if not frames:
+            return np.zeros((0, channels), dtype=np.float32)
+        # mmap держит свой дескриптор, поэтому файл можно закрыть
+        return np.memmap(raw, dtype="<f4", mode="r", shape=(frames, channels))
+
+
+def _pcm_to_float(raw, sample_width, channels):
+    if sample_width not in PCM_DTYPES:
+        raise ValueError(f"Неподдерживаемая разрядность WAV: {sample_width * 8} бит")
+    scale = float(1 << (sample_width * 8 - 1))
+    return np.frombuffer(raw, dtype=PCM_DTYPES[sample_width]).reshape(-1, channels) / scale
+
+
+def _float_to_pcm(block, sample_width):
+    scale = float(1 << (sample_width * 8 - 1))
+    pcm = np.clip(np.rint(block * scale), -scale, scale - 1)
+    return pcm.astype(PCM_DTYPES[sample_width]).tobytes()
+
+
+def peak_gain(buf, headroom_db=0.1, block_frames=BLOCK_FRAMES):
+    """Усиление для пиковой нормализации, как у pydub.effects.normalize."""
+    peak = 0.0
+    for start in range(0, len(buf), block_frames):
+        peak = max(peak, float(np.abs(buf[start:start + block_frames]).max()))
+    if peak == 0.0:
+        return 1.0
+    return 10 ** (-headroom_db / 20) / peak
+
+
+def write_wav(buf, sample_rate, output_path, gain=1.0, sample_width=2, block_frames=BLOCK_FRAMES):
+    """Записывает буфер в WAV блоками, применяя усиление."""
+    with wave.open(output_path, "wb") as dst:
+        dst.setnchannels(buf.shape[1])
+        dst.setsampwidth(sample_width)
+        dst.setframerate(sample_rate)
+        for start in range(0, len(buf), block_frames):
+            dst.writeframes(_float_to_pcm(buf[start:start + block_frames] * gain, sample_width))
+
+
+def mix_background(voice_path, bg_path, output_path, gain_db, ffmpeg="ffmpeg", block_frames=BLOCK_FRAMES):
+    """Накладывает зацикленный фон на голос блоками. Длина результата равна длине голоса."""
+    with wave.open(voice_path, "rb") as src:
+        params = src.getparams()
+        # Нужна только часть фона длиной с голос; короткий фон зацикливается ниже
+        duration = params.nframes / params.framerate
+        bg = decode(bg_path, params.framerate, params.nchannels, ffmpeg=ffmpeg, duration=duration)
+        with wave.open(output_path, "wb") as dst:
+            dst.setparams(params)
+            gain = 10 ** (gain_db / 20)
+            pos = 0
+            while True:
+                raw = src.readframes(block_frames)
+                if not raw:
+                    break
+                block = _pcm_to_float(raw, params.sampwidth, params.nchannels)
+                if len(bg):
+                    # Индексы по модулю длины фона = зацикливание без копии трека
+                    idx = np.arange(pos, pos + len(block)) % len(bg)
+                    block = block + bg[idx] * gain
+                pos += len(block)
+                dst.writeframes(_float_to_pcm(block, params.sampwidth))
+
+
+# --- Громкость: ITU-R BS.1770 / EBU R128 ---
+LOUDNESS_BLOCK_SEC = 0.4  # блок стробирования, перекрытие 75%
+LOUDNESS_ABS_GATE = -70.0
+LOUDNESS_REL_GATE = -10.0
+TRUE_PEAK_OVERSAMPLE = 4
+TRUE_PEAK_PAD = 1024  # нули после сигнала, в которых затухает интерполяция на краях
+LIMITER_RADIUS_SEC = 0.005  # окно упреждения/восстановления лимитера
+
+
+def read_wav(path):
+    """WAV целиком в float буфер (frames, channels). Для синтезированной речи, не для фона."""
+    with wave.open(path, "rb") as src:
+        params = src.getparams()
+        raw = src.readframes(params.nframes)
+    return _pcm_to_float(raw, params.sampwidth, params.nchannels), params.framerate, params.sampwidth
+
+
+def _k_weighting_response(sample_rate, n):
+    """Комплексная АЧХ K-фильтра (полка + ФВЧ из BS.1770) на частотах rfft длины n.
+
+    Коэффициенты пересчитываются под любую частоту дискретизации (как в libebur128).
+    """
+    z = np.exp(-2j * np.pi * np.fft.rfftfreq(n))  # z^-1
+
+    # 1. Высокочастотная полка ~+4 дБ (модель головы)
+    k = np.tan(np.pi * 1681.974450955533 / sample_rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    b = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0]
+    a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    shelf = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+
+    # 2. ФВЧ ~38 Гц (RLB)
+    k = np.tan(np.pi * 38.13547087602444 / sample_rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    a = [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    highpass = (1 - 2 * z + z * z) / (a[0] + a[1] * z + a[2] * z * z)
+
+    return shelf * highpass
+
+
+def integrated_loudness(buf, sample_rate):
+    """Интегральная громкость в LUFS (K-взвешивание, абсолютный и относительный гейт)."""
+    frames, channels = buf.shape
+    if not frames:
+        return float("-inf")
+    # Хвост фильтра затухает в паддинге, а не заворачивается в начало сигнала
+    n = frames + sample_rate // 2
+    spectrum = np.fft.rfft(buf, n=n, axis=0) * _k_weighting_response(sample_rate, n)[:, None]
+    weighted = np.fft.irfft(spectrum, n=n, axis=0)[:frames]
+
+    # Блок 400 мс с шагом 100 мс = среднее четырех соседних 100-мс сегментов
+    hop = int(sample_rate * LOUDNESS_BLOCK_SEC / 4)
+    segments = frames // hop
+    if segments < 4:
+        power = (weighted ** 2).mean(axis=0).sum(keepdims=True)
+    else:
+        seg_power = (weighted[:segments * hop] ** 2).reshape(segments, hop, channels).mean(axis=1).sum(axis=1)
+        power = (seg_power[:-3] + seg_power[1:-2] + seg_power[2:-1] + seg_power[3:]) / 4
+
+    with np.errstate(divide="ignore"):
+        block_lufs = -0.691 + 10 * np.log10(power)
+    gated = power[block_lufs > LOUDNESS_ABS_GATE]
+    if not len(gated):
+        return float("-inf")
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) + LOUDNESS_REL_GATE
+    gated = gated[-0.691 + 10 * np.log10(gated) > relative_gate]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def true_peak(buf):
+    """Истинный пик каждого отсчета (макс. по каналам) при 4-кратной передискретизации."""
+    frames = len(buf)
+    # Без паддинга БПФ считает сигнал периодическим, и конец заворачивается в начало
+    n = frames + TRUE_PEAK_PAD
+    spectrum = np.fft.rfft(buf, n=n, axis=0)
+    upsampled = np.fft.irfft(spectrum, n=n * TRUE_PEAK_OVERSAMPLE, axis=0) * TRUE_PEAK_OVERSAMPLE
+    upsampled = upsampled[:frames * TRUE_PEAK_OVERSAMPLE]
+    return np.abs(upsampled).reshape(frames, -1).max(axis=1)
+
+
+def _sliding_min(values, radius):
+    """Минимум в окне [i - radius, i + radius] за O(n log w) векторных операций."""
+    width = 2 * radius + 1
+    padded = np.pad(values, radius, constant_values=1.0)
+    mins, span = padded, 1
+    while span * 2 <= width:
+        mins = np.minimum(mins[:-span], mins[span:])
+        span *= 2
+    n = len(values)
+    return np.minimum(mins[:n], mins[width - span:width - span + n])
+
+
+def _sliding_mean(values, radius):
+    padded = np.pad(values, radius, mode="edge")
+    cumsum = np.concatenate([[0.0], np.cumsum(padded)])
+    return (cumsum[2 * radius + 1:] - cumsum[:-2 * radius - 1]) / (2 * radius + 1)
+
+
+def limit_true_peak(buf, sample_rate, ceiling_db=-1.0):
+    """Лимитер истинного пика с упреждением.
+
+    Требуемое ослабление сначала расширяется минимумом по окну, затем сглаживается
+    средним по окну той же ширины. Среднее минимумов не превышает требуемого
+    ослабления ни в одной точке, поэтому пики гарантированно срезаются без щелчков.
+    """
+    if not len(buf):
+        return buf
+    ceiling = 10 ** (ceiling_db / 20)
+    peaks = true_peak(buf)
+    if peaks.max() <= ceiling:
+        return buf
+    required = np.minimum(1.0, ceiling / np.maximum(peaks, 1e-12))
+    radius = max(1, int(LIMITER_RADIUS_SEC * sample_rate))
+    gain = _sliding_mean(_sliding_min(required, radius), radius)
+    return buf * gain[:, None]
+
+
+def loudness_normalize(buf, sample_rate, target_lufs, true_peak_db=-1.0):
+    """Приводит буфер к целевой интегральной громкости и ограничивает истинный пик."""
+    if not len(buf):
+        return buf
+    loudness = integrated_loudness(buf, sample_rate)
+    if loudness == float("-inf"):
+        return buf
+    gain = 10 ** ((target_lufs - loudness) / 20)
+    return limit_true_peak(buf * gain, sample_rate, true_peak_db)
+
+
+def loudness_normalize_wav(input_path, output_path, target_lufs, true_peak_db=-1.0):
+    """loudness_normalize для WAV-файла; разрядность сохраняется.
+
+    Возвращает итоговую громкость в LUFS: лимитер пика может не дать дойти до цели.
+    """
+    buf, sample_rate, sample_width = read_wav(input_path)
+    buf = loudness_normalize(buf, sample_rate, target_lufs, true_peak_db)
+    write_wav(buf, sample_rate, output_path, sample_width=sample_width)
+    return integrated_loudness(buf, sample_rate)
@@ -0,0 +1,216 @@
+"""Временные файлы синтеза с ограничением по размеру и возрасту.
+
+У каждой сессии Streamlit своя папка ScratchSpace. Результаты синтеза (wav, mp3)
+лежат в tmpfs (/dev/shm), если лимит сессии укладывается в общий бюджет tmpfs
+процесса, иначе во временной директории системы. Самые старые вытесняются при превышении лимита, но только
+вызовом evict() после того, как результат готов. Загрузки пользователя хранятся
+отдельно, всегда на диске, по одному файлу на поле загрузки. Обе папки
+удаляются вместе с сессией.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+
+SCRATCH_PREFIX = "voice_studio_"
+SCRATCH_MAX_BYTES = int(os.environ.get("SCRATCH_MAX_BYTES", str(200 * 1024 * 1024)))
+SCRATCH_MAX_AGE_SEC = float(os.environ.get("SCRATCH_MAX_AGE_SEC", "3600"))
+SCRATCH_MAX_UPLOAD_BYTES = int(os.environ.get("SCRATCH_MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+# Сколько tmpfs процесс может отдать под сессии; по умолчанию половина размера /dev/shm
+SCRATCH_SHM_BUDGET_BYTES = os.environ.get("SCRATCH_SHM_BUDGET_BYTES")
+SHM_DIR = "/dev/shm"
+
+_purged_roots = set()
+_orphans_lock = threading.Lock()
+_shm_reserved = 0  # сумма max_bytes живых сессий в tmpfs
+_shm_lock = threading.Lock()
+
+
+def _reserve_shm(max_bytes):
+    """Резервирует max_bytes в tmpfs под сессию. False, если не помещается в бюджет.
+
+    Проверки свободного места на момент создания мало: каждая сессия прошла бы ее
+    по отдельности, а вместе они переполнили бы tmpfs (в Docker /dev/shm всего 64 МБ).
+    """
+    global _shm_reserved
+    if not (os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK)):
+        return False
+    usage = shutil.disk_usage(SHM_DIR)
+    budget = int(SCRATCH_SHM_BUDGET_BYTES) if SCRATCH_SHM_BUDGET_BYTES else usage.total // 2
+    with _shm_lock:
+        # free учитывает и чужие процессы, budget - наши сессии, включая еще пустые
+        if _shm_reserved + max_bytes > budget or usage.free < max_bytes:
+            return False
+        _shm_reserved += max_bytes
+        return True
+
+
+def _release_shm(max_bytes):
+    global _shm_reserved
+    with _shm_lock:
+        _shm_reserved -= max_bytes
+
+
+def _make_dir(root):
+    with _orphans_lock:
+        if root not in _purged_roots:
+            _purge_orphans(root)
+            _purged_roots.add(root)
+    # PID владельца в имени папки: по нему другие процессы отличают брошенные папки от живых
+    return tempfile.mkdtemp(prefix=f"{SCRATCH_PREFIX}{os.getpid()}_", dir=root)
+
+
+def _pid_alive(pid):
+    if os.name == "nt":
+        # os.kill на Windows завершает процесс, а не проверяет его; считаем живым
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+
+def _purge_orphans(root):
+    """Удаляет папки сессий, чей процесс-владелец завершился (упал или был убит)."""
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not (name.startswith(SCRATCH_PREFIX) and os.path.isdir(path)):
+            continue
+        owner = name[len(SCRATCH_PREFIX):].split("_", 1)[0]
+        if not owner.isdigit() or _pid_alive(int(owner)):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class ScratchSpace:
+    def __init__(self, max_bytes=SCRATCH_MAX_BYTES, max_age_sec=SCRATCH_MAX_AGE_SEC,
+                 max_upload_bytes=SCRATCH_MAX_UPLOAD_BYTES, root=None):
+        shm_bytes = max_bytes if root is None and _reserve_shm(max_bytes) else 0
+        self.dir = _make_dir(root or (SHM_DIR if shm_bytes else tempfile.gettempdir()))
+        # Загрузки бывают длиной в час и больше, поэтому не держим их в tmpfs (в ОЗУ)
+        self.upload_dir = _make_dir(root or tempfile.gettempdir())
+        self.max_bytes = max_bytes
+        self.max_age_sec = max_age_sec
+        self.max_upload_bytes = max_upload_bytes
+        self._artifacts = {}  # путь -> время последнего обращения
+        self._derived = {}  # (исходный путь, суффикс) -> путь
+        self._uploads = {}  # поле загрузки -> (file_id, путь)
+        self.metrics = {"hits": 0, "misses": 0, "evicted_files": 0, "evicted_bytes": 0}
+        # Папки удаляются, когда сессия (и этот объект) уничтожается, или при выходе
+        self._finalizer = weakref.finalize(self, _release, shm_bytes, self.dir, self.upload_dir)
+
+    def new_path(self, suffix=""):
+        """Регистрирует и возвращает путь для нового артефакта."""
+        # Папку могли удалить снаружи (очистка /tmp), создаем заново
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, f"{uuid.uuid4().hex}{suffix}")
+        self._artifacts[path] = time.time()
+        return path
+
+    def upload(self, slot, uploaded_file, save):
+        """Копия загруженного файла на диске, одна на поле загрузки slot.
+
+        save(uploaded_file, output_path) вызывается только для нового файла.
+        Предыдущая загрузка этого поля и производные от нее артефакты удаляются.
+        Загрузки не участвуют в вытеснении, но ограничены max_upload_bytes.
+        """
+        if uploaded_file.size > self.max_upload_bytes:
+            raise ValueError(
+                f"Файл '{uploaded_file.name}' слишком большой: {uploaded_file.size / 1024 / 1024:.0f} МБ "
+                f"(максимум {self.max_upload_bytes / 1024 / 1024:.0f} МБ)"
+            )
+        current = self._uploads.get(slot)
+        if current and current[0] == uploaded_file.file_id and os.path.exists(current[1]):
+            self.metrics["hits"] += 1
+            return current[1]
+        self.metrics["misses"] += 1
+        if current:
+            self.discard(current[1])
+        os.makedirs(self.upload_dir, exist_ok=True)
+        path = os.path.join(self.upload_dir, f"{uuid.uuid4().hex}{os.path.splitext(uploaded_file.name)[1]}")
+        save(uploaded_file, path)
+        self._uploads[slot] = (uploaded_file.file_id, path)
+        return path
+
+    def touch(self, path):
+        """Отмечает использование артефакта. False, если он уже вытеснен."""
+        if path not in self._artifacts or not os.path.exists(path):
+            return False
+        self._artifacts[path] = time.time()
+        return True
+
+    def derived(self, source_path, suffix, build):
+        """Артефакт, производный от source_path (например, mp3 из wav).
+
+        build(output_path) вызывается только если его еще нет, поэтому при
+        перезапусках скрипта Streamlit повторное кодирование не выполняется.
+        """
+        key = (source_path, suffix)
+        path = self._derived.get(key)
+        if path and self.touch(path):
+            self.metrics["hits"] += 1
+            return path
+        self.metrics["misses"] += 1
+        path = self.new_path(suffix)
+        build(path)
+        self._derived[key] = path
+        return path
+
+    def discard(self, path):
+        # Производные артефакты (mp3 и т.п.) удаляются вместе с исходным
+        for key in [k for k in self._derived if k[0] == path]:
+            self.discard(self._derived.pop(key))
+        self._artifacts.pop(path, None)
+        self._derived = {k: v for k, v in self._derived.items() if v != path}
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def _sizes(self):
+        return {p: os.path.getsize(p) for p in self._artifacts if os.path.exists(p)}
+
+    def usage(self):
+        return sum(self._sizes().values())
+
+    def evict(self, keep=()):
+        """Удаляет устаревшие артефакты, затем самые давние, пока не уложимся в лимит.
+
+        Вызывается после того, как результат готов. Пути из keep (и производные
+        от них) не удаляются, даже если лимит остается превышен.
+        """
+        keep = {p for p in keep if p}
+        keep |= {v for k, v in self._derived.items() if k[0] in keep}
+        now = time.time()
+        sizes = self._sizes()
+        total = sum(sizes.values())
+        for path in sorted(self._artifacts, key=self._artifacts.get):
+            if path not in self._artifacts or path in keep:
+                # уже удален вместе с исходным артефактом или еще нужен
+                continue
+            expired = now - self._artifacts[path] > self.max_age_sec
+            if not expired and total <= self.max_bytes:
+                break
+            size = sizes.get(path, 0)
+            self.discard(path)
+            total -= size
+            self.metrics["evicted_files"] += 1
+            self.metrics["evicted_bytes"] += size
+
+    def cleanup(self):
+        self._artifacts.clear()
+        self._derived.clear()
+        self._uploads.clear()
+        self._finalizer()
+
+
+def _release(shm_bytes, *dirs):
+    for path in dirs:
+        shutil.rmtree(path, ignore_errors=True)
+    if shm_bytes:
+        _release_shm(shm_bytes)
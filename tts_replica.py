@@ -0,0 +1,156 @@
+"""Реплика модели XTTS v2 на одном устройстве.
+
+Модуль не зависит от Streamlit: его использует и приложение, и процессы-реплики
+из tts_worker.
+"""
+import contextlib
+import threading
+import time
+
+import numpy as np
+import torch
+import torchaudio
+
+# Use the 'soundfile' backend for torchaudio to avoid optional torchcodec dependency
+try:
+    torchaudio.set_audio_backend("soundfile")
+except Exception:
+    # ignore if backend can't be set; torchaudio will fall back to defaults
+    pass
+
+from TTS.api import TTS
+
+PRECISION_DTYPES = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+def load_xtts(device):
+    """Загружает XTTS v2 на устройство device."""
+    original_load = torch.load
+    # обход warning'а о weights_only в новых версиях torch
+    torch.load = lambda *args, **kwargs: original_load(*args, **kwargs, weights_only=False)
+    try:
+        # Используем XTTS v2 - он лучший для RU в open-source на данный момент
+        return TTS("tts_models/multilingual/multi-dataset/xtts_v2").to(device)
+    finally:
+        torch.load = original_load
+
+
+class ModelReplica:
+    """Одна копия модели XTTS, закрепленная за устройством."""
+    def __init__(self, model, device, precision="fp32", idle_offload_sec=0):
+        self.model = model
+        self.device = device
+        self.precision = precision
+        self.idle_offload_sec = idle_offload_sec
+        self.offloaded = False
+        self._lock = threading.Lock()
+        self._offload_timer = None
+        self._last_used = time.time()
+        if self.precision in PRECISION_DTYPES:
+            # Под autocast вокодер возвращает fp16/bf16, а XTTS конвертирует результат
+            # в numpy, который не умеет bf16. Возвращаем выход вокодера в fp32.
+            vocoder = getattr(model.synthesizer.tts_model, "hifigan_decoder", None)
+            if vocoder is not None:
+                vocoder.register_forward_hook(lambda module, inputs, output: output.float())
+        # Если заданий так и не будет, модель не должна занимать видеопамять вечно
+        self._schedule_offload()
+
+    def _autocast(self):
+        """Контекст пониженной точности; для fp32 ничего не делает."""
+        dtype = PRECISION_DTYPES.get(self.precision)
+        if dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.split(":")[0], dtype=dtype)
+
+    def _cancel_offload(self):
+        if self._offload_timer is not None:
+            self._offload_timer.cancel()
+            self._offload_timer = None
+
+    def _schedule_offload(self):
+        # Выгружать на CPU имеет смысл только с GPU
+        if self.idle_offload_sec <= 0 or not self.device.startswith("cuda"):
+            return
+        self._offload_timer = threading.Timer(self.idle_offload_sec, self._offload_if_idle)
+        self._offload_timer.daemon = True
+        self._offload_timer.start()
+
+    def _offload_if_idle(self):
+        with self._lock:
+            # Таймер мог ждать блокировку, пока шло следующее задание
+            if time.time() - self._last_used < self.idle_offload_sec:
+                return
+            self._offload()
+
+    def offload(self):
+        """Переносит веса в оперативную память и освобождает видеопамять."""
+        with self._lock:
+            self._offload()
+
+    def _offload(self):
+        if self.offloaded:
+            return
+        self.model.to("cpu")
+        self.offloaded = True
+        # empty_cache освобождает память только текущего устройства
+        with torch.cuda.device(self.device):
+            torch.cuda.empty_cache()
+
+    def _reload(self):
+        if self.offloaded:
+            self.model.to(self.device)
+            self.offloaded = False
+
+    def _run(self, job):
+        """Выполняет job() на этой реплике: загрузка на устройство, точность."""
+        with self._lock:
+            self._cancel_offload()
+            self._reload()
+            try:
+                with torch.inference_mode(), self._autocast():
+                    return job()
+            finally:
+                self._last_used = time.time()
+                self._schedule_offload()
+
+    def tts_to_file(self, **kwargs):
+        return self._run(lambda: self.model.tts_to_file(**kwargs))
+
+    def synthesize_lines(self, speaker_wav, texts, language="ru", **params):
+        """Синтезирует несколько реплик одним голосом.
+
+        Латенты голоса (разбор референса) считаются один раз на все реплики,
+        а не при каждом вызове, как в tts_to_file. Параметры разбора и сэмплирования
+        берутся из конфига модели, как в tts_to_file, чтобы голос звучал одинаково.
+        Возвращает (частота дискретизации, список float32 массивов).
+        """
+        def job():
+            xtts = self.model.synthesizer.tts_model
+            config = xtts.config
+            gpt_cond_latent, speaker_embedding = xtts.get_conditioning_latents(
+                audio_path=[speaker_wav],
+                gpt_cond_len=config.gpt_cond_len,
+                gpt_cond_chunk_len=config.gpt_cond_chunk_len,
+                max_ref_length=config.max_ref_len,
+                sound_norm_refs=config.sound_norm_refs,
+            )
+            settings = {
+                "temperature": config.temperature,
+                "length_penalty": config.length_penalty,
+                "repetition_penalty": config.repetition_penalty,
+                "top_k": config.top_k,
+                "top_p": config.top_p,
+            }
+            settings.update(params)
+            wavs = []
+            for text in texts:
+                out = xtts.inference(
+                    text, language, gpt_cond_latent, speaker_embedding,
+                    enable_text_splitting=True, **settings
+                )
+                wavs.append(np.asarray(out["wav"], dtype=np.float32))
+            return xtts.config.audio.output_sample_rate, wavs
+        return self._run(job)
@@ -0,0 +1,93 @@
+"""CPU-реплика модели в отдельном процессе, закрепленном за ядрами NUMA-узла.
+
+os.sched_setaffinity(0, ...) привязывает только вызывающий поток, а пул потоков
+torch общий на процесс и по умолчанию занимает все ядра машины. Поэтому каждая
+реплика живет в своем процессе: привязка к ядрам и число потоков torch задаются
+до импорта torch, а веса модели выделяются уже привязанным процессом и ложатся
+в память своего узла. Модуль намеренно не импортирует torch на верхнем уровне.
+"""
+import multiprocessing
+import os
+import threading
+
+
+def _cpulist(cpus):
+    """Набор ядер в формате cpulist ядра Linux: {0, 1, 2, 5} -> "0-2,5"."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def _serve(conn, cpus, precision):
+    """Точка входа процесса-реплики: загружает модель и выполняет задания из conn."""
+    os.sched_setaffinity(0, cpus)
+    # Пулы OpenMP/MKL читают переменные при старте, поэтому задаем их до импорта torch
+    os.environ["OMP_NUM_THREADS"] = os.environ["MKL_NUM_THREADS"] = str(len(cpus))
+    try:
+        import torch
+        torch.set_num_threads(len(cpus))
+        from tts_replica import ModelReplica, load_xtts
+        replica = ModelReplica(load_xtts("cpu"), "cpu", precision=precision)
+    except Exception as e:
+        conn.send(("error", f"не удалось загрузить модель: {e}"))
+        return
+    conn.send(("ok", None))
+
+    while True:
+        try:
+            method, args, kwargs = conn.recv()
+        except EOFError:
+            # Приложение завершилось
+            return
+        try:
+            conn.send(("ok", getattr(replica, method)(*args, **kwargs)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class ProcessReplica:
+    """Прокси к реплике в процессе, привязанном к набору ядер cpus.
+
+    Интерфейс совпадает с ModelReplica, поэтому ModelPool раздает задания обеим.
+    Конструктор ждет, пока модель загрузится, и пробрасывает ошибку загрузки.
+    """
+    def __init__(self, cpus, precision="fp32"):
+        self.device = f"cpu[{_cpulist(cpus)}]"
+        self.precision = precision
+        self.offloaded = False
+        self._lock = threading.Lock()
+        # spawn, а не fork: форк процесса с уже запущенными потоками torch и Streamlit небезопасен
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_serve, args=(child_conn, sorted(cpus), precision), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._receive()
+
+    def _receive(self):
+        try:
+            status, result = self._conn.recv()
+        except EOFError:
+            raise RuntimeError(f"Процесс реплики {self.device} завершился (код {self._process.exitcode})") from None
+        if status == "error":
+            raise RuntimeError(f"Реплика {self.device}: {result}")
+        return result
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            self._conn.send((method, args, kwargs))
+            return self._receive()
+
+    def tts_to_file(self, **kwargs):
+        return self._call("tts_to_file", **kwargs)
+
+    def synthesize_lines(self, speaker_wav, texts, **params):
+        return self._call("synthesize_lines", speaker_wav, texts, **params)
+
+    def offload(self):
+        # Реплика и так в оперативной памяти своего узла
+        pass